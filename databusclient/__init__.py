@@ -1,7 +1,18 @@
+import importlib
+
 from databusclient import cli
-from databusclient.client import create_dataset, deploy, create_distribution
 
 __all__ = ["create_dataset", "deploy", "create_distribution"]
 
+
+def __getattr__(name):
+    # the client module pulls in requests and SPARQLWrapper, only load it when used
+    if name == "client":
+        return importlib.import_module("databusclient.client")
+    if name in __all__:
+        return getattr(importlib.import_module("databusclient.client"), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def run():
     cli.app()
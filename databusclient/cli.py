@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 import typer
 from typing import List
-from databusclient import client
 
 app = typer.Typer()
 
@@ -26,10 +25,15 @@ def deploy(
         "and if left out inferred from the path. If the sha256sum:contentlength part is left out it will be "
         "calcuted by downloading the file.",
     ),
+    cache: bool = typer.Option(
+        True, help="reuse file stats of unchanged files from ~/.cache/databusclient"
+    ),
 ):
+    from databusclient import client
+
     typer.echo(version_id)
     dataid = client.create_dataset(
-        version_id, title, abstract, description, license_uri, distributions
+        version_id, title, abstract, description, license_uri, distributions, use_cache=cache
     )
     client.deploy(dataid=dataid, api_key=apikey)
 
@@ -40,4 +44,6 @@ def download(
     databus: str = typer.Option(..., help="databus URL"),
     databusuris: List[str] = typer.Argument(...,help="any kind of these: databus identifier, databus collection identifier, query file")
 ):
+    from databusclient import client
+
     client.download(localDir=localDir,endpoint=databus,databusURIs=databusuris)
@@ -1,15 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from enum import Enum
-from typing import List, Dict, Tuple, Optional, Union
+from typing import Iterator, List, Dict, Tuple, Optional, Union
+import csv
+import functools
+import gzip
 import requests
+from requests.adapters import HTTPAdapter, Retry
 import hashlib
+import io
 import json
+import sqlite3
 from tqdm import tqdm
-from SPARQLWrapper import SPARQLWrapper, JSON
+from tqdm.utils import CallbackIOWrapper
+from SPARQLWrapper import SPARQLWrapper, CSV
 from hashlib import sha256
 import os
+import shutil
+from urllib.parse import urlparse
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib json module is used instead
+    orjson = None
 
 __debug = False
 
+# on-disk store of already calculated file stats, see __load_file_stats
+__HASH_CACHE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "databusclient",
+    "hashes.sqlite",
+)
+
+# number of files downloaded in parallel to calculate missing file stats
+__FILE_STATS_WORKERS = 16
+
+# number of files fetched in parallel by download
+__DOWNLOAD_WORKERS = 8
+
 
 class DeployError(Exception):
     """Raised if deploy fails"""
@@ -19,6 +48,25 @@ class BadArgumentException(Exception):
     """Raised if an argument does not fit its requirements"""
 
 
+def create_session() -> requests.Session:
+    """Creates a requests session with a pooled and retrying HTTP adapter.
+    Passing the same session to several client calls reuses its connections
+    instead of doing a new TCP/TLS handshake for every request."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# default session of the module, shared by all calls that do not bring their own
+__SESSION = create_session()
+
+
 class DeployLogLevel(Enum):
     """Logging levels for the Databus deploy"""
 
@@ -27,15 +75,13 @@ class DeployLogLevel(Enum):
     debug = 2
 
 
-def __get_content_variants(distribution_str: str) -> Optional[Dict[str, str]]:
-    args = distribution_str.split("|")
-
+def __get_content_variants(parts: List[str]) -> Optional[Dict[str, str]]:
     # cv string is ALWAYS at position 1 after the URL
     # if not return empty dict and handle it separately
-    if len(args) < 2 or args[1].strip() == "":
+    if len(parts) < 2 or parts[1].strip() == "":
         return {}
 
-    cv_str = args[1].strip("_")
+    cv_str = parts[1].strip("_")
 
     cvs = {}
     for kv in cv_str.split("_"):
@@ -46,13 +92,13 @@ def __get_content_variants(distribution_str: str) -> Optional[Dict[str, str]]:
 
 
 def __get_filetype_definition(
-    distribution_str: str,
+    parts: List[str],
 ) -> Tuple[Optional[str], Optional[str]]:
     file_ext = None
     compression = None
 
     # take everything except URL
-    metadata_list = distribution_str.split("|")[1:]
+    metadata_list = parts[1:]
 
     if len(metadata_list) == 4:
         # every parameter is set
@@ -84,9 +130,9 @@ def __get_filetype_definition(
     return file_ext, compression
 
 
-def __get_extensions(distribution_str: str) -> Tuple[str, str, str]:
+def __get_extensions(parts: List[str]) -> Tuple[str, str, str]:
     extension_part = ""
-    format_extension, compression = __get_filetype_definition(distribution_str)
+    format_extension, compression = __get_filetype_definition(parts)
 
     if format_extension is not None:
         # build the format extension (only append compression if not none)
@@ -104,7 +150,7 @@ def __get_extensions(distribution_str: str) -> Tuple[str, str, str]:
     compression = "none"
 
     # get the last segment of the URL
-    last_segment = str(distribution_str).split("|")[0].split("/")[-1]
+    last_segment = parts[0].split("/")[-1]
 
     # cut of fragments and split by dots
     dot_splits = last_segment.split("#")[0].rsplit(".", 2)
@@ -123,8 +169,8 @@ def __get_extensions(distribution_str: str) -> Tuple[str, str, str]:
     return extension_part, format_extension, compression
 
 
-def __get_file_stats(distribution_str: str) -> Tuple[Optional[str], Optional[int]]:
-    metadata_list = distribution_str.split("|")[1:]
+def __get_file_stats(parts: List[str]) -> Tuple[Optional[str], Optional[int]]:
+    metadata_list = parts[1:]
     # check whether there is the shasum:length tuple separated by :
     if len(metadata_list) == 0 or ":" not in metadata_list[-1]:
         return None, None
@@ -143,32 +189,87 @@ def __get_file_stats(distribution_str: str) -> Tuple[Optional[str], Optional[int
     return sha256sum, content_length
 
 
-def __load_file_stats(url: str) -> Tuple[str, int]:
-    resp = requests.get(url)
-    if resp.status_code > 400:
-        raise requests.exceptions.RequestException(response=resp)
+def __open_hash_cache() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(__HASH_CACHE), exist_ok=True)
+    conn = sqlite3.connect(__HASH_CACHE)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS etag_file_stats "
+        "(url TEXT PRIMARY KEY, etag TEXT, size INTEGER, sha TEXT)"
+    )
+    return conn
+
+
+def __read_cached_file_stats(url: str) -> Optional[Tuple[str, int, str]]:
+    try:
+        with closing(__open_hash_cache()) as conn:
+            return conn.execute(
+                "SELECT etag, size, sha FROM etag_file_stats WHERE url = ?", (url,)
+            ).fetchone()
+    except (sqlite3.Error, OSError):
+        # cache is not usable (e.g. read-only home), just calculate
+        return None
+
+
+def __write_cached_file_stats(url: str, etag: str, size: int, sha: str) -> None:
+    try:
+        with closing(__open_hash_cache()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO etag_file_stats VALUES (?, ?, ?, ?)",
+                (url, etag, size, sha),
+            )
+    except (sqlite3.Error, OSError):
+        pass
 
-    sha256sum = hashlib.sha256(bytes(resp.content)).hexdigest()
-    content_length = len(resp.content)
-    return sha256sum, content_length
 
+def __load_file_stats(url: str, session: requests.Session, use_cache: bool = True) -> Tuple[str, int]:
+    """Loads the file and calculates its sha256sum and content length. If use_cache is set, the result is
+    cached on disk together with the ETag of the file. Later calls send it as If-None-Match, so an unchanged
+    file is answered with 304 Not Modified instead of being downloaded again. Only strong ETags promise
+    byte-identical content, so files served with a weak (W/) ETag or just a Last-Modified date are always
+    downloaded."""
+    headers = {}
+    cached = __read_cached_file_stats(url) if use_cache else None
+    if cached is not None:
+        headers["If-None-Match"] = cached[0]
 
-def __get_file_info(distribution_str: str) -> Tuple[Dict[str, str], str, str, str, int]:
-    cvs = __get_content_variants(distribution_str)
-    extension_part, format_extension, compression = __get_extensions(distribution_str)
+    # stream the file through the hash instead of holding it in memory
+    with session.get(url, headers=headers, stream=True) as resp:
+        if cached is not None and resp.status_code == 304:
+            return cached[2], cached[1]
 
-    content_variant_part = "_".join([f"{key}={value}" for key, value in cvs.items()])
+        if resp.status_code >= 400:
+            raise requests.exceptions.RequestException(response=resp)
 
-    if __debug:
-        print("DEBUG", distribution_str, extension_part)
+        # the digest is an integrity checksum, not a security feature, which lets
+        # FIPS-restricted OpenSSL builds use their regular (SHA-NI accelerated) implementation
+        sha256sum = hashlib.sha256(usedforsecurity=False)
+        content_length = 0
+        for chunk in resp.iter_content(1 << 20):  # 1 Mebibyte
+            sha256sum.update(chunk)
+            content_length += len(chunk)
+
+        etag = resp.headers.get("ETag")
 
-    sha256sum, content_length = __get_file_stats(distribution_str)
+    if use_cache and etag is not None and not etag.startswith("W/"):
+        __write_cached_file_stats(url, etag, content_length, sha256sum.hexdigest())
+    return sha256sum.hexdigest(), content_length
 
-    if sha256sum is None or content_length is None:
-        __url = str(distribution_str).split("|")[0]
-        sha256sum, content_length = __load_file_stats(__url)
 
-    return cvs, format_extension, compression, sha256sum, content_length
+def __get_file_info(
+    parts: List[str],
+) -> Tuple[str, Dict[str, str], str, str, Optional[str], Optional[int]]:
+    # parts is the distribution string split by "|", the helpers below only pick their parts from it
+    cvs = __get_content_variants(parts)
+    extension_part, format_extension, compression = __get_extensions(parts)
+
+    if __debug:
+        print("DEBUG", "|".join(parts), extension_part)
+
+    # stays None, None if not given, see create_dataset for loading them
+    sha256sum, content_length = __get_file_stats(parts)
+
+    return parts[0], cvs, format_extension, compression, sha256sum, content_length
 
 
 def create_distribution(
@@ -217,6 +318,8 @@ def create_dataset(
     group_title: str = None,
     group_abstract: str = None,
     group_description: str = None,
+    session: requests.Session = None,
+    use_cache: bool = True,
 ) -> Dict[str, Union[List[Dict[str, Union[bool, str, int, float, List]]], str]]:
     """
     Creates a Databus Dataset as a python dict from distributions and submitted metadata. WARNING: If file stats (sha256sum, content length)
@@ -247,34 +350,52 @@ def create_dataset(
         OPTIONAL! Metadata for the Group: Abstract. NOTE: Is only used if all group metadata is set
     group_description: str
         OPTIONAL! Metadata for the Group: Description. NOTE: Is only used if all group metadata is set
+    session: requests.Session
+        OPTIONAL! Session used to load missing file stats. If left out the shared session of the module is used
+    use_cache: bool
+        OPTIONAL! Reuse the file stats of unchanged files from the on-disk cache (see __HASH_CACHE) and store newly
+        calculated ones there. Set to False to always download the files and leave the cache untouched. Default is True
     """
 
+    if session is None:
+        session = __SESSION
+
     _versionId = str(version_id).strip("/")
-    _, account_name, group_name, artifact_name, version = _versionId.rsplit("/", 4)
+    base, account_name, group_name, artifact_name, version = _versionId.rsplit("/", 4)
 
-    # could be build from stuff above,
-    # was not sure if there are edge cases BASE=http://databus.example.org/"base"/...
-    group_id = _versionId.rsplit("/", 2)[0]
+    # rsplit keeps the base (e.g. BASE=http://databus.example.org/"base"/...) untouched,
+    # so the parent identifiers can be built from the parts
+    group_id = f"{base}/{account_name}/{group_name}"
 
-    artifact_id = _versionId.rsplit("/", 1)[0]
+    artifact_id = f"{group_id}/{artifact_name}"
 
-    distribution_list = []
-    for dst_string in distributions:
-        __url = str(dst_string).split("|")[0]
-        (
-            cvs,
-            formatExtension,
-            compression,
-            sha256sum,
-            content_length,
-        ) = __get_file_info(dst_string)
-
-        if not cvs and len(distributions) > 1:
-            raise BadArgumentException(
-                "If there are more than one file in the dataset, the files must be annotated "
-                "with content variants"
-            )
+    # split and parse every distribution string once
+    file_infos = [__get_file_info(str(dst_string).split("|")) for dst_string in distributions]
+
+    if len(distributions) > 1 and not all(cvs for _, cvs, *_ in file_infos):
+        raise BadArgumentException(
+            "If there are more than one file in the dataset, the files must be annotated "
+            "with content variants"
+        )
+
+    # missing file stats are calculated by downloading the file,
+    # so load them concurrently (the session is shared by all threads)
+    missing = [i for i, info in enumerate(file_infos) if info[4] is None or info[5] is None]
+    if missing:
+        with ThreadPoolExecutor(max_workers=__FILE_STATS_WORKERS) as executor:
+            loaded = executor.map(lambda i: __load_file_stats(file_infos[i][0], session, use_cache), missing)
+            for i, file_stats in zip(missing, loaded):
+                file_infos[i] = file_infos[i][:4] + file_stats
 
+    distribution_list = []
+    for (
+        __url,
+        cvs,
+        formatExtension,
+        compression,
+        sha256sum,
+        content_length,
+    ) in file_infos:
         entity = {
             "@type": "Part",
             "formatExtension": formatExtension,
@@ -354,6 +475,8 @@ def deploy(
     verify_parts: bool = False,
     log_level: DeployLogLevel = DeployLogLevel.debug,
     debug: bool = False,
+    session: requests.Session = None,
+    compress: bool = False,
 ) -> None:
     """Deploys a dataset to the databus. The endpoint is inferred from the DataID identifier.
     Parameters
@@ -368,21 +491,36 @@ def deploy(
         log level of the deploy output
     debug: bool
         controls whether output shold be printed to the console (stdout)
+    session: requests.Session
+        session used for the publish request. If left out the shared session of the module is used
+    compress: bool
+        gzip the request body (Content-Encoding: gzip). The JSON-LD of large datasets is very repetitive and shrinks a lot,
+        but the Databus needs to accept compressed requests. Default is False
     """
 
+    if session is None:
+        session = __SESSION
+
     headers = {"X-API-KEY": f"{api_key}", "Content-Type": "application/json"}
-    data = json.dumps(dataid)
+    if orjson is not None:
+        data = orjson.dumps(dataid)
+    else:
+        data = json.dumps(dataid).encode("utf-8")
     base = "/".join(dataid["@graph"][0]["@id"].split("/")[0:3])
     api_uri = (
         base
         + f"/api/publish?verify-parts={str(verify_parts).lower()}&log-level={log_level.name}"
     )
-    resp = requests.post(api_uri, data=data, headers=headers)
+    body = data
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+        body = gzip.compress(data, compresslevel=6)
+    resp = session.post(api_uri, data=body, headers=headers)
 
     if debug or __debug:
         dataset_uri = dataid["@graph"][0]["@id"]
         print(f"Trying submitting data to {dataset_uri}:")
-        print(data)
+        print(data.decode("utf-8"))
 
     if resp.status_code != 200:
         raise DeployError(f"Could not deploy dataset to databus. Reason: '{resp.text}'")
@@ -392,95 +530,167 @@ def deploy(
         print(resp.text)
 
 
-def __download_file__(url, filename):
+def __download_file__(url, filename, session: requests.Session):
     """
     Download a file from the internet with a progress bar using tqdm.
 
     Parameters:
     - url: the URL of the file to download
     - filename: the local file path where the file should be saved
+    - session: the requests session used for the download
     """
 
-    print("download "+url)    
     os.makedirs(os.path.dirname(filename), exist_ok=True) # Create the necessary directories
-    response = requests.get(url, stream=True)
-    total_size_in_bytes= int(response.headers.get('content-length', 0))
-    block_size = 1024 # 1 Kibibyte
-
-    progress_bar = tqdm(total=total_size_in_bytes, unit='iB', unit_scale=True)
-    with open(filename, 'wb') as file: 
-        for data in response.iter_content(block_size):
-            progress_bar.update(len(data))
-            file.write(data)
-    progress_bar.close()
-    if total_size_in_bytes != 0 and progress_bar.n != total_size_in_bytes:
+    with session.get(url, stream=True) as response:
+        total_size_in_bytes= int(response.headers.get('content-length', 0))
+        block_size = 1 << 20 # 1 Mebibyte
+
+        # copy the raw stream in large blocks, the wrapper only reports the progress
+        response.raw.decode_content = True
+        # disable=None only renders the bar on a terminal, not into logs of batch runs
+        progress_bar = tqdm(total=total_size_in_bytes, unit='iB', unit_scale=True, disable=None)
+        with open(filename, 'wb') as file:
+            shutil.copyfileobj(CallbackIOWrapper(progress_bar.update, response.raw, "read"), file, block_size)
+            # a disabled bar does not count, so take the size from the file
+            received_bytes = file.tell()
+        progress_bar.close()
+    if total_size_in_bytes != 0 and received_bytes != total_size_in_bytes:
         print("ERROR, something went wrong")
 
 
-def __query_sparql__(endpoint_url, query)-> dict:
+def __query_sparql__(endpoint_url, query)-> Iterator[List[str]]:
     """
-    Query a SPARQL endpoint and return results in JSON format.
+    Query a SPARQL endpoint and return the result rows, parsed from the CSV format.
 
     Parameters:
     - endpoint_url: the URL of the SPARQL endpoint
     - query: the SPARQL query string
 
     Returns:
-    - Dictionary containing the query results
+    - Iterator over the result rows, the first row holds the variable names
     """
     sparql = SPARQLWrapper(endpoint_url)
     sparql.method = 'POST'
     sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
+    sparql.setReturnFormat(CSV)
     results = sparql.query().convert()
-    return results
+    return csv.reader(io.StringIO(results.decode("utf-8")))
 
 
 def __handle__databus_file_query__(endpoint_url, query) -> List[str]:
-    result_dict = __query_sparql__(endpoint_url,query)
-    for binding in result_dict['results']['bindings']:
-        if len(binding.keys()) > 1:
-            print("Error multiple bindings in query response")
-            break
-        else:
-            value = binding[next(iter(binding.keys()))]['value']
-        yield value
+    rows = __query_sparql__(endpoint_url,query)
+    if len(next(rows, [])) > 1:
+        print("Error multiple bindings in query response")
+        return
+    for row in rows:
+        # unbound values are empty in CSV
+        if row and row[0]:
+            yield row[0]
 
 
+@functools.lru_cache(maxsize=4096)
 def wsha256(raw: str):
-    return sha256(raw.encode('utf-8')).hexdigest()
+    return sha256(raw.encode('utf-8'), usedforsecurity=False).hexdigest()
 
 
-def __handle_databus_collection__(endpoint, uri: str)-> str:
-    headers = {"Accept": "text/sparql"}
-    return requests.get(uri, headers=headers).text
+def __get_databus_id_query__(databusURI: str, endpoint: str) -> Optional[str]:
+    """
+    Build a single SPARQL query selecting the files of a databus identifier.
+    Groups and artifacts resolve to the files of the latest version of each artifact,
+    so a whole group is fetched with one request instead of one per artifact.
+
+    Parameters:
+    - databusURI: identifier of a group, artifact or version
+    - endpoint: the SPARQL endpoint of the databus, its path without /sparql is the base of the identifiers
+
+    Returns:
+    - the query string or None if the identifier is not a group, artifact or version
+    """
+    uri = databusURI.rstrip("/")
+
+    # the databus can be served below a base path (see create_dataset),
+    # only count the segments after it
+    base_path = urlparse(endpoint).path.rstrip("/").removesuffix("/sparql")
+    path = urlparse(uri).path
+    if base_path and path.startswith(base_path + "/"):
+        path = path[len(base_path):]
+    segments = path.strip("/").split("/")
+
+    if len(segments) == 4:
+        selection = f"<{uri}> dcat:distribution ?distribution ."
+    elif len(segments) in (2, 3):
+        predicate = "databus:group" if len(segments) == 2 else "databus:artifact"
+        selection = f"""?dataset {predicate} <{uri}> .
+  ?dataset databus:artifact ?artifact .
+  ?dataset dct:hasVersion ?version .
+  {{
+    SELECT ?artifact (MAX(?v) AS ?version) WHERE {{
+      ?d {predicate} <{uri}> .
+      ?d databus:artifact ?artifact .
+      ?d dct:hasVersion ?v .
+    }} GROUP BY ?artifact
+  }}
+  ?dataset dcat:distribution ?distribution ."""
+    else:
+        return None
+
+    return f"""PREFIX databus: <https://dataid.dbpedia.org/databus#>
+PREFIX dcat: <http://www.w3.org/ns/dcat#>
+PREFIX dct: <http://purl.org/dc/terms/>
+SELECT DISTINCT ?file WHERE {{
+  {selection}
+  ?distribution databus:file ?file .
+}}"""
 
 
-def __download_list__(urls: List[str], localDir: str):
-    for url in urls:
-        __download_file__(url=url,filename=localDir+"/"+wsha256(url))
+def __handle_databus_collection__(endpoint, uri: str, session: requests.Session)-> str:
+    headers = {"Accept": "text/sparql"}
+    return session.get(uri, headers=headers).text
+
+
+def __download_list__(urls: List[str], localDir: str, session: requests.Session):
+    with ThreadPoolExecutor(max_workers=__DOWNLOAD_WORKERS) as executor:
+        futures = []
+        # a query may return a URL more than once, two workers must not write the same file
+        for url in dict.fromkeys(urls):
+            # tqdm.write keeps the messages from breaking the progress bars of running downloads
+            tqdm.write("download "+url)
+            futures.append(
+                executor.submit(__download_file__, url=url, filename=localDir+"/"+wsha256(url), session=session)
+            )
+    # all downloads are finished here, raise the first error if any of them failed
+    for future in futures:
+        future.result()
 
 
 def download(
     localDir: str,
     endpoint: str,
-    databusURIs: List[str]
+    databusURIs: List[str],
+    session: requests.Session = None
 ) -> None:
     """
     Download datasets to local storage from databus registry
     ------
     localDir: the local directory
     databusURIs: identifiers to access databus registered datasets
+    session: requests session shared by all downloads, the shared session of the module if left out
     """
+    if session is None:
+        session = __SESSION
     for databusURI in databusURIs:
         # dataID or databus collection
         if databusURI.startswith("http://") or databusURI.startswith("https://"):
             # databus collection
             if "/collections/" in databusURI: #TODO "in" is not safe! there could be an artifact named collections, need to check for the correct part position in the URI
-                query = __handle_databus_collection__(endpoint,databusURI)
-                res = __handle__databus_file_query__(endpoint, query)
+                query = __handle_databus_collection__(endpoint,databusURI,session)
             else:
-                print("dataId not supported yet") #TODO add support for other DatabusIds here (artifact, group, etc.)
+                query = __get_databus_id_query__(databusURI, endpoint)
+                if query is None:
+                    print("dataId not supported yet") #TODO add support for other DatabusIds here (account, file)
+                    continue
+            res = __handle__databus_file_query__(endpoint, query)
+            __download_list__(res,localDir,session)
         # query in local file
         elif databusURI.startswith("file://"):
             print("query in file not supported yet")
@@ -488,4 +698,4 @@ def download(
         else:
             print("QUERY {}", databusURI.replace("\n"," "))
             res = __handle__databus_file_query__(endpoint,databusURI)
-            __download_list__(res,localDir)
\ No newline at end of file
+            __download_list__(res,localDir,session)
\ No newline at end of file
@@ -1,7 +1,15 @@
 """Client tests"""
 import pytest
-from databusclient.client import create_dataset, create_distribution, __get_file_info
+import databusclient.client as cl
+from databusclient.client import BadArgumentException, create_dataset, create_distribution, deploy, wsha256, __download_list__, __get_file_info, __load_file_stats
 from collections import OrderedDict
+from hashlib import sha256
+import gzip
+import io
+import json
+import requests
+import subprocess
+import sys
 
 
 EXAMPLE_URL = "https://raw.githubusercontent.com/dbpedia/databus/608482875276ef5df00f2360a2f81005e62b58bd/server/app/api/swagger.yml"
@@ -98,3 +106,208 @@ def test_empty_cvs():
     }
 
     assert dataset == correct_dataset
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, headers=None, content=b""):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = content
+        self.raw = io.BytesIO(content)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield self.content
+
+
+class FakeSession:
+    """Records the (method, url, headers, data) of each request and answers it with respond(url, headers)"""
+
+    def __init__(self, respond=lambda url, headers: FakeResponse()):
+        self.respond = respond
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(("GET", url, headers, None))
+        return self.respond(url, headers or {})
+
+    def post(self, url, data=None, headers=None, **kwargs):
+        self.requests.append(("POST", url, headers, data))
+        return self.respond(url, headers or {})
+
+
+@pytest.fixture
+def hash_cache(tmp_path, monkeypatch):
+    path = tmp_path / "hashes.sqlite"
+    monkeypatch.setattr(cl, "__HASH_CACHE", str(path))
+    return path
+
+
+def test_file_stats_cache(hash_cache):
+    def respond(url, headers):
+        if headers.get("If-None-Match") == '"v1"':
+            return FakeResponse(304)
+        return FakeResponse(headers={"ETag": '"v1"'}, content=b"databus")
+
+    session = FakeSession(respond)
+
+    first = __load_file_stats(EXAMPLE_URL, session)
+    second = __load_file_stats(EXAMPLE_URL, session)
+
+    assert first == second == (sha256(b"databus").hexdigest(), 7)
+    # one plain GET, then a conditional one answered without a body
+    assert [headers for _, _, headers, _ in session.requests] == [{}, {"If-None-Match": '"v1"'}]
+
+
+@pytest.mark.parametrize(
+    "validator",
+    [{}, {"Last-Modified": "Thu, 01 Jan 1970 00:00:00 GMT"}, {"ETag": 'W/"v1"'}],
+)
+def test_file_stats_without_strong_etag_are_not_cached(hash_cache, validator):
+    # a Last-Modified date or a weak ETag does not promise byte-identical content
+    session = FakeSession(lambda url, headers: FakeResponse(headers=validator, content=b"databus"))
+
+    __load_file_stats(EXAMPLE_URL, session)
+    __load_file_stats(EXAMPLE_URL, session)
+
+    assert [headers for _, _, headers, _ in session.requests] == [{}, {}]
+
+
+def test_file_stats_cache_opt_out(hash_cache):
+    session = FakeSession(lambda url, headers: FakeResponse(headers={"ETag": '"v1"'}, content=b"databus"))
+
+    __load_file_stats(EXAMPLE_URL, session, use_cache=False)
+    __load_file_stats(EXAMPLE_URL, session, use_cache=False)
+
+    assert [headers for _, _, headers, _ in session.requests] == [{}, {}]
+    assert not hash_cache.exists()
+
+
+def test_create_dataset_keeps_distribution_order():
+    sha = "79582a2a7712c0ce78a74bb55b253dc2064931364cf9c17c827370edf9b7e4f1"
+    dst = [
+        create_distribution(EXAMPLE_URL, {"type": "a"}, "yml", None, (sha, 1)),
+        create_distribution(EXAMPLE_URL, {"type": "b"}, "json", "gz", (sha, 2)),
+    ]
+
+    dataset = create_dataset(
+        version_id="https://dev.databus.dbpedia.org/user/group/artifact/1970.01.01/",
+        title="Test Title",
+        abstract="Test abstract blabla",
+        description="Test description blabla",
+        license_url="https://license.url/test/",
+        distributions=dst,
+    )
+
+    parts = dataset["@graph"][-1]["distribution"]
+    assert [(p["dcv:type"], p["formatExtension"], p["compression"], p["byteSize"]) for p in parts] == [
+        ("a", "yml", "none", 1),
+        ("b", "json", "gz", 2),
+    ]
+
+
+def test_create_dataset_requires_content_variants():
+    dst = [EXAMPLE_URL, create_distribution(EXAMPLE_URL, {"type": "b"})]
+
+    with pytest.raises(BadArgumentException):
+        create_dataset(
+            version_id="https://dev.databus.dbpedia.org/user/group/artifact/1970.01.01/",
+            title="Test Title",
+            abstract="Test abstract blabla",
+            description="Test description blabla",
+            license_url="https://license.url/test/",
+            distributions=dst,
+        )
+
+
+def test_create_dataset_only_loads_missing_file_stats(hash_cache):
+    session = FakeSession(lambda url, headers: FakeResponse(content=b"databus"))
+    sha = "79582a2a7712c0ce78a74bb55b253dc2064931364cf9c17c827370edf9b7e4f1"
+    dst = [
+        create_distribution("https://example.org/given.yml", {"type": "a"}, "yml", None, (sha, 1)),
+        create_distribution("https://example.org/missing.yml", {"type": "b"}, "yml"),
+    ]
+
+    dataset = create_dataset(
+        version_id="https://dev.databus.dbpedia.org/user/group/artifact/1970.01.01/",
+        title="Test Title",
+        abstract="Test abstract blabla",
+        description="Test description blabla",
+        license_url="https://license.url/test/",
+        distributions=dst,
+        session=session,
+    )
+
+    parts = dataset["@graph"][-1]["distribution"]
+    assert [url for _, url, _, _ in session.requests] == ["https://example.org/missing.yml"]
+    assert [(p["sha256sum"], p["byteSize"]) for p in parts] == [
+        (sha, 1),
+        (sha256(b"databus").hexdigest(), 7),
+    ]
+
+
+EXAMPLE_DATAID = {
+    "@context": "https://downloads.dbpedia.org/databus/context.jsonld",
+    "@graph": [{"@id": "https://databus.example.org/user/group/artifact/1970.01.01#Dataset", "title": "Test Title"}],
+}
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_deploy_compress(compress):
+    session = FakeSession()
+    deploy(EXAMPLE_DATAID, "key", session=session, compress=compress)
+
+    [(_, url, headers, body)] = session.requests
+    assert url.startswith("https://databus.example.org/api/publish?")
+    if compress:
+        assert headers["Content-Encoding"] == "gzip"
+        body = gzip.decompress(body)
+    else:
+        assert "Content-Encoding" not in headers
+    assert json.loads(body) == EXAMPLE_DATAID
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_deploy_body_is_json_bytes(monkeypatch, use_orjson):
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(cl, "orjson", None)
+    session = FakeSession()
+    deploy(EXAMPLE_DATAID, "key", session=session)
+
+    [(_, _, _, body)] = session.requests
+    assert isinstance(body, bytes)
+    assert json.loads(body) == EXAMPLE_DATAID
+
+
+def test_client_module_is_reachable_from_the_package():
+    # run in a fresh interpreter, this test module has already imported databusclient.client
+    code = "import databusclient; print(databusclient.client.download.__name__)"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    assert out.strip() == "download"
+
+
+def test_download_list_writes_each_file_once(tmp_path):
+    files = {"https://example.org/a.ttl": b"aaa", "https://example.org/b.ttl": b"bb"}
+    broken = "https://example.org/broken.ttl"
+
+    def respond(url, headers):
+        if url == broken:
+            raise requests.exceptions.ConnectionError(url)
+        return FakeResponse(headers={"content-length": str(len(files[url]))}, content=files[url])
+
+    session = FakeSession(respond)
+
+    # the error of the broken URL is only raised after the other downloads are done
+    with pytest.raises(requests.exceptions.ConnectionError):
+        __download_list__([*files, broken, *files], str(tmp_path), session)
+
+    assert sorted(url for _, url, _, _ in session.requests) == sorted([*files, broken])
+    for url, content in files.items():
+        assert (tmp_path / wsha256(url)).read_bytes() == content
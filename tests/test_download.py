@@ -1,6 +1,7 @@
 """Download Tests"""
 import pytest
 import databusclient.client as cl
+from databusclient.client import __get_databus_id_query__, __handle__databus_file_query__
 
 DEFAULT_ENDPOINT="https://databus.dbpedia.org/sparql"
 TEST_QUERY="""
@@ -11,10 +12,75 @@ SELECT ?x WHERE {
 """
 TEST_COLLECTION="https://databus.dbpedia.org/dbpedia/collections/dbpedia-snapshot-2022-12"
 
+@pytest.mark.integration
 def test_with_query():
   cl.download("tmp",DEFAULT_ENDPOINT,[TEST_QUERY]
 
 )
   
-def test_with_collection():
-  cl.download("tmp",DEFAULT_ENDPOINT,[TEST_COLLECTION])
\ No newline at end of file
+@pytest.mark.integration
+def test_with_collection(monkeypatch):
+  # only resolve the collection, downloading the whole snapshot is too much for CI
+  resolved = []
+  monkeypatch.setattr(cl, "__download_list__", lambda urls, localDir, session: resolved.extend(urls))
+  cl.download("tmp",DEFAULT_ENDPOINT,[TEST_COLLECTION])
+
+  assert resolved
+  assert all(url.startswith("http") for url in resolved)
+
+def test_databus_id_query():
+  group = __get_databus_id_query__("https://databus.dbpedia.org/dbpedia/mappings/", DEFAULT_ENDPOINT)
+  artifact = __get_databus_id_query__("https://databus.dbpedia.org/dbpedia/mappings/geo-coordinates-mappingbased", DEFAULT_ENDPOINT)
+  version = __get_databus_id_query__("https://databus.dbpedia.org/dbpedia/mappings/geo-coordinates-mappingbased/2022.12.01", DEFAULT_ENDPOINT)
+
+  assert "?d databus:group <https://databus.dbpedia.org/dbpedia/mappings> ." in group
+  assert "?d databus:artifact <https://databus.dbpedia.org/dbpedia/mappings/geo-coordinates-mappingbased> ." in artifact
+  assert "<https://databus.dbpedia.org/dbpedia/mappings/geo-coordinates-mappingbased/2022.12.01> dcat:distribution ?distribution ." in version
+  assert __get_databus_id_query__("https://databus.dbpedia.org/dbpedia", DEFAULT_ENDPOINT) is None
+
+def test_databus_id_query_with_base_path():
+  endpoint = "https://example.org/databus/sparql"
+  artifact = __get_databus_id_query__("https://example.org/databus/dbpedia/mappings/geo-coordinates-mappingbased", endpoint)
+  version = __get_databus_id_query__("https://example.org/databus/dbpedia/mappings/geo-coordinates-mappingbased/2022.12.01", endpoint)
+
+  assert "?d databus:artifact <https://example.org/databus/dbpedia/mappings/geo-coordinates-mappingbased> ." in artifact
+  assert "<https://example.org/databus/dbpedia/mappings/geo-coordinates-mappingbased/2022.12.01> dcat:distribution ?distribution ." in version
+  assert __get_databus_id_query__("https://example.org/databus/dbpedia", endpoint) is None
+
+class FakeSPARQLWrapper:
+  """Answers every query with the CSV document in result"""
+  result = b""
+
+  def __init__(self, endpoint):
+    self.method = "GET"
+
+  def setQuery(self, query):
+    pass
+
+  def setReturnFormat(self, format):
+    pass
+
+  def query(self):
+    return self
+
+  def convert(self):
+    return self.result
+
+@pytest.mark.parametrize("result,files", [
+  # unbound values are empty cells (or empty lines) in CSV
+  (b'file\r\nhttps://example.org/a.ttl\r\n\r\n""\r\nhttps://example.org/b.ttl\r\n', ["https://example.org/a.ttl", "https://example.org/b.ttl"]),
+  # quoted values keep their commas
+  (b'file\r\n"https://example.org/a,b.ttl"\r\n', ["https://example.org/a,b.ttl"]),
+])
+def test_file_query_csv_results(monkeypatch, result, files):
+  monkeypatch.setattr(FakeSPARQLWrapper, "result", result)
+  monkeypatch.setattr(cl, "SPARQLWrapper", FakeSPARQLWrapper)
+
+  assert list(__handle__databus_file_query__(DEFAULT_ENDPOINT, TEST_QUERY)) == files
+
+def test_file_query_with_multiple_bindings(monkeypatch, capsys):
+  monkeypatch.setattr(FakeSPARQLWrapper, "result", b"file,size\r\nhttps://example.org/a.ttl,3\r\n")
+  monkeypatch.setattr(cl, "SPARQLWrapper", FakeSPARQLWrapper)
+
+  assert list(__handle__databus_file_query__(DEFAULT_ENDPOINT, TEST_QUERY)) == []
+  assert "Error multiple bindings in query response" in capsys.readouterr().out